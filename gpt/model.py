@@ -11,12 +11,44 @@ from typing import Optional
 @dataclass
 class ModelArgs:
     max_seq_len: int = 1024 # max sequence length (context window)
-    vocab_size: int = 50257 # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <|endoftext|> token
+    vocab_size: int = 50304 # GPT-2 vocab is 50,257 (50,000 BPE merges + 256 bytes tokens + 1 <|endoftext|>), padded to a multiple of 128 for tensor-core-aligned GEMMs
     n_layers: int = 12 # number of layers
     n_heads: int = 12 # number of heads
     n_embd: int = 768 # embedding dimension
     multiple_of: int = 256  # make SwiGLU hidden layer size multiple of large power of 2
     ffn_dim_multiplier: Optional[float] = None  # hidden layer size in feedforward network is ffn_dim_multiplier times n_embd
+    use_fp8: bool = False # use Transformer Engine Linear/LayerNorm so GEMMs can run at FP8 on Hopper
+    tie_weights: bool = False # share wte and lm_head: one (V, n_embd) matrix instead of two; opt-in because the shared tensor keeps the embedding-scale init, discarding the muP readout scaling from-scratch runs rely on
+
+
+def _linear_layernorm_cls(use_fp8: bool):
+    """Picks the Linear/LayerNorm implementation; Transformer Engine modules
+    run their GEMMs at FP8 on fourth-generation tensor cores when the forward
+    is wrapped in te.fp8_autocast. Outside the FP8 path we prefer Apex
+    FusedLayerNorm (mean/var/normalize/affine in one CUDA kernel) when it is
+    installed; it is state-dict compatible with nn.LayerNorm."""
+    if use_fp8:
+        import transformer_engine.pytorch as te
+        return te.Linear, te.LayerNorm
+    try:
+        from apex.normalization import FusedLayerNorm
+    except ImportError:
+        FusedLayerNorm = nn.LayerNorm
+    return nn.Linear, FusedLayerNorm
+
+
+def quantize_int8(model):
+    """Weight-only INT8 (W8A16) quantization of the Linear layers for
+    inference: weights shrink 4x vs FP32, halving the HBM traffic that
+    dominates batch-1 decoding. lm_head stays full precision since
+    quantizing it is the usual accuracy cliff."""
+    from torchao.quantization import int8_weight_only, quantize_
+    quantize_(
+        model,
+        int8_weight_only(),
+        filter_fn=lambda m, fqn: isinstance(m, nn.Linear) and fqn != "lm_head",
+    )
+    return model
 
 
 class CausalSelfAttention(nn.Module):
@@ -30,8 +62,9 @@ class CausalSelfAttention(nn.Module):
         ), "embed_dim must be divisible by num_heads"
         assert self.n_embd % self.n_heads == 0
 
-        self.c_attn = nn.Linear(self.n_embd, 3 * self.n_embd)
-        self.c_proj = nn.Linear(self.n_embd, self.n_embd)
+        Linear, _ = _linear_layernorm_cls(config.use_fp8)
+        self.c_attn = Linear(self.n_embd, 3 * self.n_embd)
+        self.c_proj = Linear(self.n_embd, self.n_embd)
 
         # Custom initialization for linear layers (muP-initialization)
         for name, param in self.c_attn.named_parameters():
@@ -41,35 +74,57 @@ class CausalSelfAttention(nn.Module):
             if "weight" in name:
                 torch.nn.init.normal_(param, mean=0, std=alpha * (1 / config.n_embd) ** 0.5)
 
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
-        qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_heads, C // self.n_heads).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_heads, C // self.n_heads).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_heads, C // self.n_heads).transpose(1, 2) # (B, nh, T, hs)
+        # one view + permute over the packed projection instead of split + three
+        # view/transpose pairs: no extra kernels, no intermediate allocations.
+        # No .contiguous() either — SDPA's fused backends only require the
+        # stride-1 head dimension these views already have
+        qkv = self.c_attn(x).view(B, T, 3, self.n_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0) # each (B, nh, T, hs)
+
+        if past_kv is not None:
+            # autoregressive decoding: x holds only the newly appended token;
+            # extend the cached keys/values along the sequence axis. One token
+            # at a time only — is_causal=False below would let a multi-token
+            # continuation attend to its own future positions
+            assert T == 1, "cached decoding expects a single new token per step"
+            past_k, past_v = past_kv
+            k = torch.cat((past_k, k), dim=2)
+            v = torch.cat((past_v, v), dim=2)
+        present = (k, v) if use_cache else None
 
         # scale=1 / self.head_dim -> # mup
-        # Flash Attention custom cuda kernels
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True) # (B, nh, T, hs)
+        # is_causal derives the mask inside the kernel, so no (T, T) mask
+        # buffer is ever registered or materialized per layer.
+        # Flash Attention custom cuda kernels; with a cache the new queries sit
+        # at the end of the sequence and may attend to everything cached, so
+        # the causal mask is only needed on the full-sequence (prefill) pass
+        y = F.scaled_dot_product_attention(q, k, v, dropout_p=0.0, is_causal=past_kv is None) # (B, nh, T, hs)
 
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
+        # re-assemble all head outputs side by side; reshape copies only when
+        # the strides actually require it (e.g. the T=1 decode step is a view)
+        y = y.transpose(1, 2).reshape(B, T, C)
         # output projection
         y = self.c_proj(y)
-        return y
+        return y, present
 
 class FeedForward(nn.Module):
     def __init__(
             self,
             n_embd: int,
             hidden_dim: int,
+            use_fp8: bool = False,
             ):
         super().__init__()
         self.n_embd = n_embd
         self.hidden_dim = hidden_dim
-        self.c_fc    = nn.Linear(self.n_embd, self.hidden_dim)
-        self.gelu    = nn.GELU()
-        self.c_proj  = nn.Linear(self.hidden_dim, self.n_embd)
+        Linear, _ = _linear_layernorm_cls(use_fp8)
+        self.c_fc    = Linear(self.n_embd, self.hidden_dim)
+        # tanh approximation: the polynomial GPT-2 shipped with, vectorizes on
+        # CPU and fuses into the c_fc epilogue under torch.compile on GPU
+        self.gelu    = nn.GELU(approximate="tanh")
+        self.c_proj  = Linear(self.hidden_dim, self.n_embd)
 
     def forward(self, x):
         x = self.c_fc(x)
@@ -84,12 +139,14 @@ class TransformerBlock(nn.Module):
         self.n_heads = config.n_heads
         self.n_embd = config.n_embd
         self.head_dim = config.n_embd // config.n_heads
-        self.ln_1 = nn.LayerNorm(self.n_embd)
+        _, LayerNorm = _linear_layernorm_cls(config.use_fp8)
+        self.ln_1 = LayerNorm(self.n_embd)
         self.attn = CausalSelfAttention(config)
-        self.ln_2 = nn.LayerNorm(self.n_embd)
+        self.ln_2 = LayerNorm(self.n_embd)
         self.mlp = FeedForward(
             n_embd=config.n_embd,
-            hidden_dim=4 * config.n_embd
+            hidden_dim=4 * config.n_embd,
+            use_fp8=config.use_fp8,
         )
 
         for name, param in self.mlp.named_parameters():
@@ -98,9 +155,18 @@ class TransformerBlock(nn.Module):
             else:
                 init.zeros_(param)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, past_kv=None, use_cache=False):
+        # residual-add + LayerNorm is the memory-bound pair here; under
+        # --torch-compile TorchInductor fuses each add with the following LN
+        # so the residual never round-trips through HBM between them
+        attn_out, present = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=use_cache)
+        x = x + attn_out
         x = x + self.mlp(self.ln_2(x))
+        # without a cache return just the tensor: reentrant checkpoint
+        # implementations expect flat tensor outputs, so nothing nested may
+        # cross the checkpoint boundary
+        if use_cache:
+            return x, present
         return x
 
 
@@ -109,17 +175,30 @@ class Transformer(nn.Module):
         super().__init__()
         self.config = config
 
+        _, LayerNorm = _linear_layernorm_cls(config.use_fp8)
         self.transformer = nn.ModuleDict(dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.max_seq_len, config.n_embd),
             h = nn.ModuleList([TransformerBlock(config) for _ in range(config.n_layers)]),
-            ln_f = nn.LayerNorm(config.n_embd),
+            ln_f = LayerNorm(config.n_embd),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
 
         self.loss_fn = nn.CrossEntropyLoss()
+        try:
+            # computes lm_head GEMM + log-softmax + NLL in SRAM tiles, so the
+            # (B*T, vocab_size) logits tensor is never materialized in HBM
+            from liger_kernel.transformers import LigerFusedLinearCrossEntropyLoss
+            self.fused_loss_fn = LigerFusedLinearCrossEntropyLoss()
+        except ImportError:
+            self.fused_loss_fn = None
+        self._gradient_checkpointing_func = None
 
-        init.normal_(self.lm_head.weight, mean=0, std=alpha * (1 / config.n_embd))
+        if config.tie_weights:
+            # the shared matrix gets the embedding-scale init below
+            self.lm_head.weight = self.transformer.wte.weight
+        else:
+            init.normal_(self.lm_head.weight, mean=0, std=alpha * (1 / config.n_embd))
         init.normal_(self.transformer.wte.weight, mean=0, std=alpha * 3.3)
     
     def gradient_checkpointing_enabled(self, ds_config):
@@ -128,23 +207,65 @@ class Transformer(nn.Module):
         self._gradient_checkpointing_func = checkpointing.checkpoint
         self.num_checkpoints = ds_config['activation_checkpointing']['number_checkpoints']
 
-    def forward(self, idx):
-        # idx is of shape (B, T)
+    def gradient_checkpointing_enable(self):
+        """Plain-PyTorch activation checkpointing for runs without DeepSpeed."""
+        from functools import partial
+        from torch.utils.checkpoint import checkpoint
+        self._gradient_checkpointing_func = partial(checkpoint, use_reentrant=False)
+
+    def forward(self, idx, past_kv=None, use_cache=False):
+        # idx is of shape (B, T); during cached generation it holds only the
+        # newly appended token(s) and past_kv carries one (k, v) pair per layer
         B, T = idx.size()
+        past_len = 0 if past_kv is None else past_kv[0][0].size(2)
         # forward the token and posisition embeddings
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (T, n_embd)
-        tok_emb = self.transformer.wte(idx) # token embeddings of shape (B, T, n_embd)
-        x = tok_emb + pos_emb
-        # forward the blocks of the transformer
-        for block in self.transformer.h:
-            x = block(x)
+        pos = torch.arange(past_len, past_len + T, dtype=torch.long, device=idx.device) # shape (T)
+        # token embeddings (B, T, n_embd) + broadcast position embeddings (T, n_embd);
+        # the in-place add skips one (B, T, C) allocation and write per step — safe
+        # because embedding backward only needs the indices, never its output
+        x = self.transformer.wte(idx).add_(self.transformer.wpe(pos))
+        # forward the blocks of the transformer; when checkpointing is enabled
+        # the block activations are recomputed in backward instead of stashed,
+        # cutting activation memory by ~n_layers at the cost of one extra
+        # forward per block
+        checkpointing = (
+            self._gradient_checkpointing_func is not None
+            and self.training
+            and past_kv is None
+        )
+        # each present is a view of the per-layer qkv buffer, so building the
+        # cache pins every layer's 3*B*T*C activations until the caller drops
+        # the outputs dict; only the generation loop wants that, so use_cache
+        # is an explicit opt-in rather than inferred from eval mode
+        presents = [] if use_cache else None
+        for i, block in enumerate(self.transformer.h):
+            if checkpointing:
+                # block defaults to use_cache=False, so the checkpointed call
+                # takes and returns a plain tensor only
+                x = self._gradient_checkpointing_func(block, x)
+            elif use_cache:
+                x, present = block(x, past_kv=past_kv[i] if past_kv is not None else None, use_cache=True)
+                presents.append(present)
+            else:
+                x = block(x, past_kv=past_kv[i] if past_kv is not None else None)
         # forward the final layernorm and the classifier
         x = self.transformer.ln_f(x)
+
+        if past_kv is None and self.training and self.fused_loss_fn is not None:
+            # training only needs the loss; the fused kernel tiles the lm_head
+            # projection into the reduction, reclaiming the ~3 GB the full
+            # FP32 logits would occupy at B=16, T=1024
+            shift_x = x[..., :-1, :].contiguous()
+            shift_labels = idx[..., 1:].contiguous()
+            loss = self.fused_loss_fn(
+                self.lm_head.weight, shift_x.view(-1, shift_x.size(-1)), shift_labels.view(-1)
+            )
+            return {"loss": loss, "past_kv": presents}
+
         logits = self.lm_head(x) # (B, T, vocab_size)
 
-        outputs = {"logits": logits}
-        if idx is not None:
+        outputs = {"logits": logits, "past_kv": presents}
+        if past_kv is None:
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = idx[..., 1:].contiguous()
 
@@ -168,7 +289,8 @@ class Transformer(nn.Module):
             'gpt2-large':   dict(n_layers=36, n_heads=20, n_embd=1280), # 774M params
             'gpt2-xl':      dict(n_layers=48, n_heads=25, n_embd=1600), # 1558M params
         }[model_type]
-        config_args["vocab_size"] = 50257 # always 50257 for GPT model checkpoints
+        config_args["vocab_size"] = 50304 # checkpoints ship 50257 rows; we pad to 50304 for aligned GEMMs
+        config_args["tie_weights"] = True # HF GPT-2 ties them anyway; the init is overwritten below so the muP concern does not apply
         config_args["max_seq_len"] = 1024 # always 1024 for GPT model checkpoints
         # create a from-scratch initialized GPT model
         config = ModelArgs(**config_args)
@@ -190,11 +312,22 @@ class Transformer(nn.Module):
         # this means that we have to transpose these weights when we import them
         assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
         for k in sd_keys_hf:
+            if config.tie_weights and k == "lm_head.weight":
+                # shares storage with transformer.wte.weight (HF ties them too),
+                # so one copy covers both keys
+                continue
             if any(k.endswith(w) for w in transposed):
                 # special treatment for the Conv1D weights we need to transpose
                 assert sd_hf[k].shape[::-1] == sd[k].shape
                 with torch.no_grad():
                     sd[k].copy_(sd_hf[k].t())
+            elif k in ("transformer.wte.weight", "lm_head.weight"):
+                # the HF checkpoint only has 50257 vocab rows; copy them into
+                # the first rows and zero the padding (never indexed by real tokens)
+                assert sd_hf[k].shape[0] <= sd[k].shape[0] and sd_hf[k].shape[1:] == sd[k].shape[1:]
+                with torch.no_grad():
+                    sd[k][:sd_hf[k].shape[0]].copy_(sd_hf[k])
+                    sd[k][sd_hf[k].shape[0]:].zero_()
             else:
                 # vanilla copy over the other parameters
                 assert sd_hf[k].shape == sd[k].shape
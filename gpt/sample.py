@@ -1,15 +1,31 @@
 import torch
 from torch.nn import functional as F
 import tiktoken
-from model import Transformer
+from model import Transformer, quantize_int8
 
 
 num_return_sequences = 5
 max_length = 30
+int8_weights = False # weight-only INT8: ~2x less weight HBM traffic at batch-1 (needs torchao)
+use_jit = False # trace+freeze to cut per-op Python dispatch overhead; the trace
+                # is shape-specialized, so this path always feeds a fixed
+                # (B, max_length) input instead of the KV-cache path
 
 model = Transformer.from_pretrained("gpt2")
 model.eval()
 model.to('cuda')
+if int8_weights:
+    model = quantize_int8(model)
+
+
+class LogitsOnly(torch.nn.Module):
+    """Traceable wrapper: a plain tensor-to-tensor forward for torch.jit."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, idx):
+        return self.model(idx)["logits"]
 
 # prefix tokens
 enc = tiktoken.get_encoding('gpt2')
@@ -22,10 +38,32 @@ x = tokens.to('cuda')
 # set the seed to 42
 torch.manual_seed(42)
 torch.cuda.manual_seed(42)
+if use_jit:
+    with torch.no_grad():
+        # trace at the full (B, max_length) shape: B, T and the position range
+        # are baked into the graph as constants, so every call must use this
+        # exact shape. freeze() requires the traced module to be in eval mode.
+        example = torch.zeros(num_return_sequences, max_length, dtype=torch.long, device='cuda')
+        frozen = torch.jit.freeze(torch.jit.trace(LogitsOnly(model).eval(), example))
+past_kv = None
 while x.size(1) < max_length:
-    # forward the model to get the logits
+    # forward the model to get the logits; after the first (prefill) pass only
+    # the newly sampled token goes through the model, the per-layer k/v for
+    # the prefix come from the cache -> O(T) total work instead of O(T^2)
     with torch.no_grad():
-        logits = model(x)["logits"] # (B, T, vocab_size)
+        if use_jit:
+            # zero-pad up to the traced length; causal attention means the
+            # padding can never influence the logits at position T-1
+            T = x.size(1)
+            padded = torch.cat((x, x.new_zeros(x.size(0), max_length - T)), dim=1)
+            logits = frozen(padded)[:, T - 1 : T, :] # (B, 1, vocab_size)
+        else:
+            if past_kv is None:
+                outputs = model(x, use_cache=True)
+            else:
+                outputs = model(x[:, -1:], past_kv=past_kv, use_cache=True)
+            past_kv = outputs["past_kv"]
+            logits = outputs["logits"] # (B, T, vocab_size)
         # take the logits at the last position
         logits = logits[:, -1, :] # (B, vocab_size)
         # get the probabilities
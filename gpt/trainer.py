@@ -1,8 +1,10 @@
 # very much based on deepspeed-examples.
 # https://github.com/microsoft/DeepSpeedExamples/blob/master/applications/DeepSpeed-Chat/training/step1_supervised_finetuning/main.py
 
+import contextlib
 import json
 import math
+import os
 import random
 
 from typing import Optional
@@ -28,37 +30,62 @@ app = typer.Typer()
 
 
 class WikiTextDataset(Dataset):
-    def __init__(self, tokenizer, type_path="train", max_length=512):
+    def __init__(self, tokenizer, type_path="train", max_length=512, cache_dir="."):
         self.vernum = 103
-        self.dataset = load_dataset(
-            "wikitext", f"wikitext-{self.vernum}-raw-v1", split=type_path
-        )
-        self.tokenizer = tokenizer
         self.max_length = max_length
+        # tokenize the whole split once and memmap the uint16 token matrix on
+        # later runs: GPT-2 ids fit in 16 bits, so the cache is a quarter the
+        # size of int64 and startup drops from minutes to milliseconds
+        cache_file = os.path.join(
+            cache_dir, f"wikitext-{self.vernum}-{type_path}-{max_length}.bin"
+        )
+        if not os.path.exists(cache_file):
+            dataset = load_dataset(
+                "wikitext", f"wikitext-{self.vernum}-raw-v1", split=type_path
+            )
+            input_ids = tokenizer(
+                dataset["text"],
+                max_length=max_length,
+                padding="max_length",
+                truncation=True,
+                return_tensors="np",
+            ).input_ids.astype(np.uint16)
+            # write-then-rename so concurrent ranks never read a torn file
+            input_ids.tofile(cache_file + f".tmp{os.getpid()}")
+            os.replace(cache_file + f".tmp{os.getpid()}", cache_file)
+        self.tokens = np.memmap(cache_file, dtype=np.uint16, mode="r").reshape(
+            -1, max_length
+        )
 
     def __len__(self):
-        return int(len(self.dataset))
+        return self.tokens.shape[0]
 
     def __getitem__(self, idx):
-        text = self.dataset[idx]["text"]
-        # logger.info(text)
-        inputs = self.tokenizer(
-            text,
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
-        )
-        return {"input_ids": inputs.input_ids.squeeze()}
+        # widen to int64 only at lookup time, right before the wte embedding
+        return {"input_ids": torch.from_numpy(self.tokens[idx].astype(np.int64))}
 
 
-def train(ds_engine, train_loader, device):
+def fp8_autocast_context(fp8):
+    """te.fp8_autocast with the delayed-scaling recipe, or a no-op context."""
+    if not fp8:
+        return contextlib.nullcontext()
+    import transformer_engine.pytorch as te
+    from transformer_engine.common.recipe import DelayedScaling, Format
+
+    recipe = DelayedScaling(fp8_format=Format.HYBRID, amax_history_len=16)
+    return te.fp8_autocast(enabled=True, fp8_recipe=recipe)
+
+
+def train(ds_engine, train_loader, device, fp8=False):
     ds_engine.train()
     total_loss = 0
     for _, batch in enumerate(train_loader):
-        input_ids = batch["input_ids"].to(device)
+        # batches come out of pinned memory, so the H2D copy is async and
+        # overlaps with the tail of the previous step
+        input_ids = batch["input_ids"].to(device, non_blocking=True)
 
-        outputs = ds_engine(input_ids)
+        with fp8_autocast_context(fp8):
+            outputs = ds_engine(input_ids)
         loss = outputs["loss"]
         total_loss += loss.item()
         if torch.distributed.get_rank() == 0:
@@ -84,7 +111,7 @@ def validate(model, val_loader, device):
     total_loss = 0
     with torch.no_grad():
         for _, batch in enumerate(val_loader):
-            input_ids = batch["input_ids"].to(device)
+            input_ids = batch["input_ids"].to(device, non_blocking=True)
             outputs = model(input_ids)
             loss = outputs["loss"]
             total_loss += loss.float()
@@ -132,8 +159,13 @@ def main(
     num_train_epochs: Optional[int] = 1,
     lr_scheduler_type: Optional[str] = "linear",
     profile: Optional[bool] = False,
+    torch_compile: Optional[bool] = False,
+    bf16: Optional[bool] = True,
+    fp8: Optional[bool] = False,
 ):
     set_seed(seed)
+    # Use TF32 tensor cores for the FP32 matmuls that remain outside autocast.
+    torch.set_float32_matmul_precision("high")
     assert model_type in {"gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"}
     # n_layers, n_heads and n_embd are determined from model_type
     config = {
@@ -171,7 +203,9 @@ def main(
             "stage3_prefetch_bucket_size": 3e7,
             "memory_efficient_linear": False,
         },
-        "bfloat16": {"enabled": True},
+        # GEMMs and attention run on BF16 tensor cores while DeepSpeed keeps
+        # FP32 master params for the optimizer; no loss scaler needed.
+        "bfloat16": {"enabled": bf16},
         "gradient_clipping": 1.0,
     }  # wall_clock_breakdown -> profile breakdown of time spent in different parts of the training loop
     # ref: https://www.deepspeed.ai/docs/config-json/#bfloat16-training-options
@@ -223,7 +257,9 @@ def main(
     tokenizer = AutoTokenizer.from_pretrained("gpt2")
     tokenizer.pad_token = tokenizer.eos_token
     
-    config = ModelArgs(**config)
+    # wte/lm_head stay untied for training: tying would drop the muP readout
+    # init, and under ZeRO-3 the shared parameter would be partitioned twice
+    config = ModelArgs(**config, use_fp8=fp8)
     with deepspeed.zero.Init():
         model = Transformer(config)
 
@@ -258,12 +294,14 @@ def main(
         collate_fn=default_data_collator,
         sampler=train_sampler,
         batch_size=train_micro_batch_size_per_gpu,
+        pin_memory=True,
     )
     val_loader = DataLoader(
         val_dataset,
         collate_fn=default_data_collator,
         sampler=eval_sampler,
         batch_size=train_micro_batch_size_per_gpu * 2,
+        pin_memory=True,
     )
     # weight decay config
     no_decay_name_list = [
@@ -300,6 +338,9 @@ def main(
     with open("./opt_config.json", "w") as json_file:
         json.dump(final_optimizer_settings, json_file, indent=4)
 
+    # FusedAdam applies the whole update as one multi_tensor_apply CUDA kernel
+    # instead of a Python loop of per-parameter addcmul_ launches; the CPU
+    # variant is the AVX-vectorized equivalent for offloaded optimizer state
     AdamOptimizer = DeepSpeedCPUAdam if offload else FusedAdam
 
     optimizer = AdamOptimizer(
@@ -313,6 +354,14 @@ def main(
         num_training_steps=num_train_epochs * math.ceil(len(train_loader)),
     )
 
+    if torch_compile:
+        # TorchInductor fuses the pointwise chains (residual-add+LN, GELU,
+        # embedding add) into far fewer kernels, cutting HBM round-trips and
+        # launch overhead. Compile after the optimizer groups are built so the
+        # _orig_mod. prefix does not leak into the parameter names.
+        torch._dynamo.config.cache_size_limit = 64
+        model = torch.compile(model)
+
     model_engine, optimizer, _, lr_scheduler = deepspeed.initialize(
         model=model, config=ds_config, lr_scheduler=lr_scheduler, optimizer=optimizer
     )
@@ -323,7 +372,7 @@ def main(
         else:
             train_sampler.set_epoch(epoch)
 
-        avg_train_loss = train(model_engine, train_loader, model_engine.device)
+        avg_train_loss = train(model_engine, train_loader, model_engine.device, fp8=fp8)
         
         logger.info(f"Epoch {epoch+1}, Train Loss: {avg_train_loss}")
         eval_loss, perp = validate(model_engine, val_loader, device=device)